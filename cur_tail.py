@@ -2,18 +2,71 @@
 '''Function that provides the latest zenith value'''
 
 from pathlib import Path
-from .eldata import DataType, ElData
+from time import monotonic
+import numpy as np
+from .eldata import ElData
 from .common import get_latest_path, get_previous_path
 
 DIRBASE = Path('/data/gb/logbdata/el_enc')
 
+ENC_ZERO = 7062  # encoder value at the zenith, see `enc2z`
+_INV900 = 1.0/900  # encoder counts per degree, inverted
+
+LATEST_TTL = 1.0  # seconds to reuse the result of get_latest_path
+
+# ElData of the latest file, reused while the file is not modified
+_LAST = {'path': None, 'mtime': None, 'eld': None}
+# Latest path and the time it was searched
+_PATH_CACHE = {'path': None, 'time': None}
+
 def enc2z(enc_val):
 #    ''' Formula valid around 2019-10 '''
 #    return (enc_val - 9113)/900
 #    ''' Formula valid around 2022-0112 '''
 #    return (enc_val - 6234)/900
     ''' Formula valid around 2022-0829 '''
-    return (enc_val - 7062)/900
+    return (enc_val - ENC_ZERO)*_INV900
+
+
+def enc2z_arr(enc_array):
+    '''Vectorized `enc2z` for arrays of encoder values
+    Parameter
+    ---------
+    enc_array: array-like
+        Encoder values
+
+    Returns
+    -------
+    zenith: np.ndarray
+        Zenith values in float64
+    '''
+    zenith = np.subtract(enc_array, ENC_ZERO, dtype=np.float64)
+    zenith *= _INV900
+    return zenith
+
+
+def _get_latest_path():
+    '''get_latest_path(DIRBASE), searched at most once per LATEST_TTL'''
+    now = monotonic()
+    if (_PATH_CACHE['time'] is None) or (now - _PATH_CACHE['time'] > LATEST_TTL):
+        _PATH_CACHE['path'] = get_latest_path(DIRBASE)
+        _PATH_CACHE['time'] = now
+
+    return _PATH_CACHE['path']
+
+
+def _get_eldata(path):
+    '''ElData of the given path, reused from the previous call if the
+    file has not been modified since'''
+    mtime = path.stat().st_mtime_ns
+    if (path, mtime) != (_LAST['path'], _LAST['mtime']):
+        if _LAST['eld'] is not None:
+            _LAST['eld'].close()
+        _LAST['eld'] = ElData(path)
+        _LAST['path'] = path
+        _LAST['mtime'] = mtime
+
+    return _LAST['eld']
 
 
 def get_latest_zenith():
@@ -22,24 +75,19 @@ def get_latest_zenith():
     zenith: float
         Latest zenith value
     '''
-    latest_path = get_latest_path(DIRBASE)
+    latest_path = _get_latest_path()
     try:
-        tmpeld = ElData(latest_path)
-
-        for i in range(tmpeld.length):
-            _, data, d_type = tmpeld.get_data(tmpeld.length - i - 1)
-            if d_type == DataType.DATA:
-                return enc2z(data)
+        tail = _get_eldata(latest_path).get_tail_data()
+        if tail is not None:
+            return enc2z(tail[1])
     except Exception as err:
         print(err)
 
     # Reach here if the latest path does not have enough length
     second_path = get_previous_path(latest_path)
-    tmpeld = ElData(second_path)
-    for i in range(tmpeld.length):
-        _, data, d_type = tmpeld.get_data(tmpeld.length - i - 1)
-        if d_type == DataType.DATA:
-            return enc2z(data)
+    tail = ElData(second_path).get_tail_data()
+    if tail is not None:
+        return enc2z(tail[1])
 
     raise RuntimeError('Caonnt find the latest.')
 
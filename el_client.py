@@ -10,11 +10,26 @@ class ElClient:
     '''Client class to read latest elevation data
     '''
     def __init__(self, ip_addr=IP_ADDRESS, port=EL_PORT):
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._ip_addr = ip_addr
         self._port = port
+        self._buf = bytearray(4096)  # reused for every response
+        self._sock = None
+        self._connect()
+
+    def _connect(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Small request/response: do not wait for Nagle's algorithm
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         self._sock.connect((self._ip_addr, self._port))
 
+    def _query(self):
+        self._sock.sendall('e#zenith?'.encode('utf-8'))
+        num = self._sock.recv_into(self._buf)
+        if num == 0:
+            raise ConnectionError('Connection closed by the server.')
+        return float(self._buf[:num])
+
     def get_zenith(self):
         '''Get zenith angle
         Returns
@@ -22,10 +37,12 @@ class ElClient:
         res: float
             Response from the server
         '''
-        #self._sock.connect((self._ip_addr, self._port))
-        self._sock.send('e#zenith?'.encode('utf-8'))
-        res = self._sock.recv(4096)
-        return float(res)
+        try:
+            return self._query()
+        except OSError:  # Reconnect once if the connection is lost
+            self._sock.close()
+            self._connect()
+            return self._query()
 
 def main():
     '''Main function'''
@@ -1,10 +1,11 @@
 import socket
+import struct
 import fcntl
 import mmap
 import os
+import select
 import sys
 from pathlib import Path
-from queue import Queue
 from threading import Thread
 from time import sleep
 
@@ -18,6 +19,28 @@ PATH_DEV_BASE = Path(f'/sys/devices/platform/axi/{ADDR_AXI:08x}.axi_fifo_mm_s/ui
 PATH_LOCK = Path(__file__).parent.joinpath('.lock')
 # offset of timestamp
 LEAP_OFFSET = 37
+# destination of the encoder data
+SERVER_ADDR = ('192.168.215.210', 8080)
+# number of packets in the software fifo
+RING_SIZE = 1 << 16
+# maximum number of packets sent at once
+SEND_BATCH = 1024
+# kernel send buffer size in bytes
+SEND_BUFSIZE = 4*1024*1024
+# packet sent to the server: [length 2 bytes][data 12 bytes]
+FRAME_DTYPE = np.dtype([('len', '<u2'), ('data', '<u4', (3,))])
+# packet sent to the server by UDP: [sequence number 4 bytes][data 12 bytes]
+DGRAM_DTYPE = np.dtype([('seq', '<u4'), ('data', '<u4', (3,))])
+# number of packets in a UDP datagram (fits in an ethernet frame)
+DGRAM_BATCH = 90
+# value written to the uio device to enable the interrupt
+IRQ_ENABLE = (1).to_bytes(4, sys.byteorder)
+# timeout of waiting for the interrupt in seconds
+IRQ_TIMEOUT = 0.1
+# polling interval in seconds when the interrupt is not available
+POLL_INTERVAL = 0.01
+
+_WORDS = struct.Struct('<III')
 
 # error class
 class el_EncError(Exception):
@@ -38,7 +61,24 @@ class el_EncTime:
     '''
 
     def __init__(self, time_raw):
-        self._time_raw = time_raw
+        self._sec = time_raw >> 46
+        self._nsec = (0x_00000000_00003fff_ffff0000 & time_raw) >> 16
+
+    @classmethod
+    def from_words(cls, word0, word1, word2):
+        '''
+        Build from the three 32 bit words of the raw data
+        without composing the 94 bit integer.
+
+        Parameters
+        ----------
+        word0, word1, word2 : int
+            Lower to upper 32 bit words. The top 2 bits of `word2` are ignored.
+        '''
+        time = cls.__new__(cls)
+        time._sec = ((word2 & 0x3fffffff) << 18) | (word1 >> 14)
+        time._nsec = ((word1 & 0x3fff) << 16) | (word0 >> 16)
+        return time
 
     @property
     def sec(self):
@@ -50,7 +90,7 @@ class el_EncTime:
         sec : int
             Seconds part of timestamp.
         '''
-        return self._time_raw >> 46
+        return self._sec
 
     @property
     def nsec(self):
@@ -62,7 +102,7 @@ class el_EncTime:
         nsec : int
             Nano-sec part of timestamp.
         '''
-        return (0x_00000000_00003fff_ffff0000 & self._time_raw) >> 16
+        return self._nsec
 
     @property
     def tai(self):
@@ -95,12 +135,11 @@ class el_EncTime:
 
         Returns
         -------
-        time_g3 : np.int64
+        time_g3 : int
             G3Time
         '''
-        time_g3 = np.floor((self.utc) * 1e8)
-
-        return np.int64(time_g3)
+        # 1 G3Time tick = 10 ns. Integer arithmetic avoids float rounding.
+        return (self.sec - LEAP_OFFSET) * 100_000_000 + self.nsec // 10
 
 # data class
 class el_EncData:
@@ -115,11 +154,13 @@ class el_EncData:
 
     def __init__(self, data_bytes):
         self._data_bytes = data_bytes
-        self._data_int = int(data_bytes[0]) + (int(data_bytes[1]) << 32) + (int(data_bytes[2]) << 64)
+        self._w0 = int(data_bytes[0])
+        self._w1 = int(data_bytes[1])
+        self._w2 = int(data_bytes[2])
 
     @property
     def state(self):
-        return (self._data_int & 0xC0_00_00_00_00000000_00000000) >> 94
+        return self._w2 >> 30
 
     @property
     def time_raw(self):
@@ -130,7 +171,7 @@ class el_EncData:
         time_raw : int
             94 bit TSU timestamp.
         '''
-        return self._data_int & 0x3F_FF_FF_FF_FFFFFFFF_FFFFFFFF
+        return ((self._w2 & 0x3fffffff) << 64) | (self._w1 << 32) | self._w0
 
     @property
     def time(self):
@@ -142,7 +183,10 @@ class el_EncData:
         time : StmTime
             TSU timestamp abstraction.
         '''
-        return el_EncTime(self.time_raw)
+        return el_EncTime.from_words(self._w0, self._w1, self._w2)
+
+    def __bytes__(self):
+        return _WORDS.pack(self._w0, self._w1, self._w2)
 
     def __str__(self):
         return f'time={int(self.time.g3)/1e8:.8f} data={self.state:02b}'
@@ -176,10 +220,13 @@ class el_EncReader:
         Path to the generic-uio device file for axi_fifo_mm_s IP.
     path_lock : str or pathlib.Path
         Path to the lockfile.
+    transport : {'tcp', 'udp'}
+        Protocol to send the data to the server.
+        'udp' has no connection state and should be used only on a trusted LAN.
     '''
 
     # initialize method -> open the uio device and memorry mapping with mmap
-    def __init__(self, path_dev, path_lock=PATH_LOCK, verbose=True):
+    def __init__(self, path_dev, path_lock=PATH_LOCK, verbose=True, transport='tcp'):
         # Verbose level
         self._verbose = verbose
 
@@ -194,9 +241,33 @@ class el_EncReader:
         self._path_dev = path_dev
         self._dfile = os.open(self._path_dev, os.O_RDONLY | os.O_SYNC)
         self._dev = mmap.mmap(self._dfile, 0x100, mmap.MAP_SHARED, mmap.PROT_READ, offset=0)
+        # registers as 32 bit words, created once and reused
+        self._regs = np.frombuffer(self._dev, dtype=np.uint32, count=0x100//4)
 
-        # Data FIFO
-        self.fifo = Queue()
+        # Interrupt: a read on the uio device blocks until the next IRQ
+        try:
+            self._irq = os.open(self._path_dev, os.O_RDWR)
+        except OSError:
+            self._eprint('Interrupt is not available. Polling.')
+            self._irq = None
+
+        # Data FIFO: single-producer single-consumer ring of data words.
+        # `_tail` is advanced only by `fill` and `_head` only by `pop_block`,
+        # so no lock is needed.
+        self._ring = np.empty((RING_SIZE, 3), dtype=np.uint32)
+        self._head = 0
+        self._tail = 0
+
+        # Persistent connection to the server, opened on the first send
+        if transport not in ('tcp', 'udp'):
+            raise el_EncError(f'Unknown transport: {transport}')
+        self._transport = transport
+        self._tcp = None
+        self._udp = None
+        if transport == 'udp':
+            self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._udp.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFSIZE)
+        self._seq = 0
 
         # Runner
         self._thread = None
@@ -205,7 +276,13 @@ class el_EncReader:
     def __del__(self):
         if self._running:
             self.stop()
+        self._close_tcp()
+        if self._udp is not None:
+            self._udp.close()
+        if self._irq is not None:
+            os.close(self._irq)
         fcntl.flock(self._fp_lock, fcntl.LOCK_UN)
+        del self._regs
         self._dev.close()
         os.close(self._dfile)
 
@@ -218,54 +295,162 @@ class el_EncReader:
     # read the data
     def _get_info(self):
          # access to FPGA
-        data = np.frombuffer(self._dev, np.uint32, 4, offset=0)
-        r_len = data[0]
-        w_len = data[1]
-        residue = data[2]
+        r_len = int(self._regs[0])
+        w_len = int(self._regs[1])
+        residue = int(self._regs[2])
 
         return r_len, w_len, residue
 
-    def _get_data(self):
-        data = np.frombuffer(self._dev, np.uint32, 4, offset=16)
+    def _connect_tcp(self):
+        tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # large buffer so that bursts do not block the reader thread
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFSIZE)
+        tcp_socket.connect(SERVER_ADDR)
+        self._tcp = tcp_socket
 
-        return el_EncData(data)
+    def _close_tcp(self):
+        if self._tcp is not None:
+            self._tcp.close()
+            self._tcp = None
 
     def send_data_tcp(self, data):
+        '''
+        Send bytes over the persistent TCP connection.
+        The connection is opened again at the next call after an error.
+
+        Parameters
+        ----------
+        data : bytes
+            Framed packets.
+        '''
         try:
-          # make socket
-            tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-          # connect to the server
-            tcp_socket.connect(('192.168.215.210', 8080))
-          # send the data
-            tcp_socket.sendall(data)
-          # close the socket
-            tcp_socket.close()
+            if self._tcp is None:
+                self._connect_tcp()
+            self._tcp.sendall(data)
         except Exception as e:
             print(f"Error in send_data_tcp: {e}")
+            self._close_tcp()
+
+    def send_data_udp(self, block):
+        '''
+        Send packets by UDP, `DGRAM_BATCH` packets per datagram.
+        Each packet is prefixed with a sequence number in 4 bytes
+        (little endian) so that the server can detect loss and reordering.
+
+        Parameters
+        ----------
+        block : ndarray
+            Rows of data words from the software fifo.
+        '''
+        dgrams = np.empty(len(block), dtype=DGRAM_DTYPE)
+        dgrams['seq'] = (self._seq + np.arange(len(block))) & 0xffffffff
+        dgrams['data'] = block
+        self._seq += len(block)
+
+        buf = dgrams.tobytes()
+        step = DGRAM_BATCH*DGRAM_DTYPE.itemsize
+        try:
+            for start in range(0, len(buf), step):
+                self._udp.sendto(buf[start:start + step], SERVER_ADDR)
+        except Exception as e:
+            print(f"Error in send_data_udp: {e}")
+
+    def drain(self):
+        '''
+        Send the packets in the software fifo to the server.
+        By TCP, each packet is prefixed with its length in 2 bytes
+        (little endian), and each block of the fifo is sent with one `sendall`.
+        '''
+        while True:
+            block = self.pop_block()
+            if len(block) == 0:
+                break
+
+            if self._transport == 'udp':
+                self.send_data_udp(block)
+                continue
+
+            frames = np.empty(len(block), dtype=FRAME_DTYPE)
+            frames['len'] = FRAME_DTYPE['data'].itemsize
+            frames['data'] = block
+            self.send_data_tcp(frames.tobytes())
 
     def fill(self):
         '''
         Get data from PL fifo and put into software fifo.
+        When the software fifo is full, the rest is left in the PL fifo.
         '''
-        while True:
+        while self._tail - self._head < RING_SIZE:
             r_len, w_len, residue = self._get_info()
 
             if (r_len == 0) and (residue == 0):
                 break
 
-            self.fifo.put(self._get_data())
+            # Three 32-bit reads of the data registers, word by word
+            row = self._ring[self._tail % RING_SIZE]
+            row[0] = self._regs[4]
+            row[1] = self._regs[5]
+            row[2] = self._regs[6]
+            self._tail += 1
+
+    def pop_block(self, num=SEND_BATCH):
+        '''
+        Take packets out of the software fifo.
+
+        Parameters
+        ----------
+        num : int
+            Maximum number of packets.
+
+        Returns
+        -------
+        block : ndarray
+            Rows of 3 data words. Use `el_EncData(row)` to decode a row.
+        '''
+        start = self._head % RING_SIZE
+        num = min(num, self._tail - self._head, RING_SIZE - start)
+        block = self._ring[start:start + num].copy()
+        self._head += num
+
+        return block
+
+    def _arm_irq(self):
+        if self._irq is None:
+            return
+        try:
+            os.write(self._irq, IRQ_ENABLE)
+        except OSError:
+            self._eprint('Interrupt cannot be enabled. Polling.')
+            os.close(self._irq)
+            self._irq = None
+
+    def _wait(self):
+        '''
+        Wait for the interrupt from the PL fifo.
+        Falls back to polling if the interrupt is not available.
+        '''
+        if self._irq is None:
+            sleep(POLL_INTERVAL)
+            return
+
+        readable, _, _ = select.select([self._irq], [], [], IRQ_TIMEOUT)
+        if readable:
+            os.read(self._irq, 4)
 
     # inifinity loop of reading data
     def _loop(self):
         while self._running:
+            # enable the interrupt before emptying the PL fifo
+            # so that data arriving afterwards wakes us up
+            self._arm_irq()
             self.fill()
 
            # take the data from queue and send by TCP
-            while not self.fifo.empty():
-                data = self.fifo.get()
-                self.send_data_tcp(data)
+            self.drain()
 
-            sleep(0.1)
+            self._wait()
 
     # start
     def run(self):
@@ -289,19 +474,13 @@ def main():
     '''Main function to boot infinite loop'''
     el_enc = el_EncReader(get_path_dev(), verbose=True)
 
-    # Filler loop
-    fd = open('test.dat', 'w')
+    # Filler loop. The software fifo is consumed by the reader thread.
     el_enc.run()
     while True:
         try:
-            while not el_enc.fifo.empty():
-                data = el_enc.fifo.get()
-                print(data)
-                fd.write(str(data) + '\n')
             sleep(0.1)
         except KeyboardInterrupt:
             el_enc.stop()
-            fd.close()
             break
 
     print('Fin.')
@@ -13,16 +13,20 @@ class ElServer:
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._sock.bind((ip_addr, port))
+        self._buf = memoryview(bytearray(1024))  # reused for every request
 
     def run(self):
         '''Run server program'''
         self._sock.listen(10)
         while True:
             clientsock, _ = self._sock.accept()
+            clientsock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            clientsock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             while True:
-                rcvmsg = clientsock.recv(1024)
-                if len(rcvmsg) == 0:
+                num = clientsock.recv_into(self._buf)
+                if num == 0:
                     break
+                rcvmsg = bytes(self._buf[:num])
                 print('Received -> %s' % (rcvmsg))
                 rcvmsg = rcvmsg.decode().strip()
                 if rcvmsg == 'e#zenith?':
@@ -2,11 +2,12 @@
 '''Module to read elevation encoder data
 '''
 from datetime import datetime, timezone
-from collections import deque
 from enum import Enum
 from pathlib import Path
 
 import lzma
+import mmap
+import struct
 import warnings
 import numpy as np
 
@@ -16,6 +17,16 @@ from .common import get_next_path, get_previous_path
 PACKET_LENGTH = 12
 BUFFER_LENGTH = 128
 SEEK_LENGTH = 1000
+TAIL_LENGTH = 4096
+
+# Packet layout: [HEADER 2 bytes][stamp 4 bytes][data 4 bytes][FOOTER 2 bytes]
+PKT_DTYPE = np.dtype([('hdr', '<u2'), ('stamp', '<u4'),
+                      ('data', '<i4'), ('foot', '<u2')])
+HEADER_U16 = 0x1207  # b'\x07\x12'
+FOOT_DATA = 0xDA7A  # b'z\xda'
+FOOT_SYNC = 0x570C  # b'\x0cW'
+FOOT_UART = 0x2048  # b'H '
+_PKT = struct.Struct('<HIiH')
 
 class DataType(Enum):
     '''Elevation data type
@@ -68,34 +79,112 @@ def parsebytes(d_bytes):
     d_type: DataType
         Data type
     '''
-    if d_bytes[0:2] != b'\x07\x12':
-        raise Exception('HEADER ERROR: {}'.format(d_bytes[0:2]))
-    if d_bytes[10:12] == b'z\xda':  # DATA
+    header, timestamp, data, footer = _PKT.unpack_from(d_bytes)
+    if header != HEADER_U16:
+        raise Exception('HEADER ERROR: {}'.format(bytes(d_bytes[0:2])))
+    if footer == FOOT_DATA:
         d_type = DataType.DATA
-    elif d_bytes[10:12] == b'\x0cW':  # SYNC
+    elif footer == FOOT_SYNC:
         d_type = DataType.SYNC
-    elif d_bytes[10:12] == b'H ':  # UART
+    elif footer == FOOT_UART:
         d_type = DataType.UART
     else:
-        raise Exception('FOOTER ERROR ', d_bytes[10:12])
-
-    timestamp = int.from_bytes(d_bytes[2:6], 'little')
-    data = int.from_bytes(d_bytes[6:10], 'little', signed=True)
+        raise Exception('FOOTER ERROR ', bytes(d_bytes[10:12]))
 
     return timestamp, data, d_type
 
 
 
 
+def classify(arr):
+    '''Vectorized packet type check of structured packets
+    Parameter
+    ---------
+    arr: np.ndarray
+        Packets with `PKT_DTYPE`
+
+    Returns
+    -------
+    is_data: np.ndarray
+        True for DATA packets
+    is_sync: np.ndarray
+        True for SYNC packets. The others are UART packets.
+    '''
+    if np.any(arr['hdr'] != HEADER_U16):
+        raise Exception('HEADER ERROR')
+    foot = arr['foot']
+    is_data = foot == FOOT_DATA
+    is_sync = foot == FOOT_SYNC
+    if not np.all(is_data | is_sync | (foot == FOOT_UART)):
+        raise Exception('FOOTER ERROR')
+
+    return is_data, is_sync
+
+
+def _xz_varint(buf, pos):
+    '''Decode a multibyte integer of the xz format at `pos`'''
+    value = 0
+    for _i in range(9):
+        byte = buf[pos + _i]
+        value |= (byte & 0x7F) << 7*_i
+        if byte < 0x80:
+            return value, pos + _i + 1
+    raise ValueError('Invalid xz integer')
+
+
+def xz_size(path):
+    '''Uncompressed size of a single-stream xz file read from its index
+    Parameter
+    ---------
+    path: pathlib.Path
+        Path to the xz file
+
+    Returns
+    -------
+    size: int or None
+        Uncompressed size in bytes, None if it cannot be determined
+        (e.g. concatenated streams or stream padding)
+    '''
+    try:
+        with open(path, 'rb') as _f:
+            f_size = _f.seek(0, 2)
+            _f.seek(-12, 2)
+            footer = _f.read(12)
+            if footer[10:] != b'YZ':
+                return None
+            index_size = (int.from_bytes(footer[4:8], 'little') + 1)*4
+            _f.seek(-12 - index_size, 2)
+            index = _f.read(index_size)
+
+        if index[0] != 0:
+            return None
+        num, pos = _xz_varint(index, 1)
+        size = 0
+        blocks = 0
+        for _ in range(num):
+            unpadded, pos = _xz_varint(index, pos)
+            uncompressed, pos = _xz_varint(index, pos)
+            blocks += (unpadded + 3) & ~3
+            size += uncompressed
+    except (OSError, IndexError, ValueError):
+        return None
+
+    # Stream header + blocks + index + stream footer should fill the file
+    if 12 + blocks + index_size + 12 != f_size:
+        return None
+    return size
+
+
 class ElEOF(Exception):
     '''Exception signaling EOF during reading elevation encoder file'''
 
 
 class ElData:
     '''Elevation data class'''
-    def __init__(self, path, use_deque=True, preinfo=False, postinfo=False):
+    def __init__(self, path, use_deque=None, preinfo=False, postinfo=False):
         self._path = Path(path)
         self._fd = None
+        self._mm = None
         if self._path.suffix == '.xz':
             self._fd = lzma.open(self._path, 'rb')
             self._isxz = True
@@ -119,16 +208,18 @@ class ElData:
         if self._isxz:
             self._length = None
         else:
-            self._length = int((self._path.stat().st_size - self._hlen)
-                               / PACKET_LENGTH)
-
-        # Data buffer
-        self._use_deque = use_deque
-        if use_deque:
-            self._buffer = deque()
-        else:
-            self._buffer = []
-
+            # Packets are read directly from the memory map
+            self._mm = mmap.mmap(self._fd.fileno(), 0, prot=mmap.PROT_READ)
+            self._mv = memoryview(self._mm)
+            self._pos = self._hlen
+            self._length = int((len(self._mm) - self._hlen)/PACKET_LENGTH)
+
+        if use_deque is not None:
+            warnings.warn('`use_deque` is deprecated and has no effect: '
+                          'packets are no longer buffered one by one',
+                          DeprecationWarning, stacklevel=2)
+
+        self._rows = None  # Row iterator used by `__next__`
         self._fin = False
 
         # Sync information
@@ -159,7 +250,6 @@ class ElData:
             self._sync_info.append([self._sync_stamp,
                                     self._sync_id,
                                     self._sync_offset])
-
         self._postinfo = postinfo
         self._init = False
         self.__sstamp = None
@@ -201,6 +291,10 @@ class ElData:
     def length(self):
         '''Length of the file in packets'''
         if self._length is None:
+            size = xz_size(self._path)
+            if size is not None:
+                self._length = int((size - self._hlen)/PACKET_LENGTH)
+                return self._length
             cur_pos = self._fd.tell()
             pos = self._fd.seek(0, whence=2)
             self._length = int((pos-self._hlen)/PACKET_LENGTH)
@@ -224,28 +318,72 @@ class ElData:
         return self.__sstamp
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        '''Close the file'''
+        if self._mm is not None:
+            self._mv.release()
+            try:
+                self._mm.close()
+            except BufferError:  # Arrays still refer to the map
+                pass
+            self._mm = None
         if self._fd and (not self._fd.closed):
             self._fd.close()
 
     def __iter__(self):
-        self._fd.seek(self._hlen)
+        self._seek(0)
+        # Files are parsed as one block and served row by row
+        self._rows = self._iter_rows()
         return self
 
-    def _sync_replace(self):
-        start = self._buffer[0][0]
-        if self._sync_stamp < start:
-            if self._sstamp <= self._sync_stamp:
+    def __next__(self):
+        if self._rows is None:
+            self._rows = self._iter_rows()
+        return next(self._rows)
+
+    def _iter_rows(self):
+        rows = self.parse_all()
+        for start in range(0, len(rows), BUFFER_LENGTH):
+            yield from rows[start:start + BUFFER_LENGTH].tolist()
+
+    def _sync_index(self, start, sync_stamp):
+        '''First position in the window starting from the timestamp `start`
+        that can belong to the synchronization starting at `sync_stamp`'''
+        if sync_stamp < start:
+            if self._sstamp <= sync_stamp:
                 raise Exception('Buffer too short')
-            index = 0
-        else:
-            index = self._sync_stamp - start + 1
+            return 0
 
-        for _i in range(index, len(self._buffer)):
-            if self._buffer[_i][0] > self._sync_stamp:
-                self._buffer[_i][2] = self._sync_id
-                self._buffer[_i][3] = self._sync_offset
-            else:  # This will occur when timestamp goes 2**32-1 -> 0
-                print(f'mismatch: {_i}, {self._buffer[_i]}')
+        return sync_stamp - start + 1
+
+    def _eof_sync(self, start):
+        '''Set synchronization for the packets left in the window at EOF
+        Parameter
+        ---------
+        start: int
+            Timestamp of the first packet in the window
+        '''
+        if self._postinfo is False:
+            self._sync_stamp = start
+            self._sync_id = -1
+            self._sync_offset = 0
+        else:
+            if isinstance(self._postinfo, bool):
+                path_next = get_next_path(self._path)
+                ned = ElData(path_next)
+                if not self._skip:  # searching for synchronization
+                    self._sync_id = ned.defrag(self._sync_id,
+                                               self._sync_count)
+                else:
+                    (self._sync_stamp,
+                     self._sync_id,
+                     self._sync_offset), _ = ned.get_first_sync()
+            else:
+                (self._sync_stamp,
+                 self._sync_id,
+                 self._sync_offset), _ = self._postinfo
 
     def _sync_push(self, packet):
         stamp, data, d_type = packet
@@ -279,10 +417,6 @@ class ElData:
 
             if self._sync_count == 6:  # flush
                 if not self._skip:
-                    # Calculation for the replacement
-                    if len(self._buffer) > 0:
-                        self._sync_replace()
-
                     # Push info
                     self._sync_info.append([self._sync_stamp,
                                             self._sync_id,
@@ -294,66 +428,6 @@ class ElData:
             return
 
 
-    def __next__(self):
-        # Buffer flush
-        if self._fin:
-            if len(self._buffer) == 0:
-                raise StopIteration()
-            if self._use_deque:
-                return self._buffer.popleft()
-            return self._buffer.pop(0)
-
-        # File read
-        try:
-            tmpd = self._read()
-        except ElEOF:  # finalization
-            self._fin = True
-            if self._postinfo is False:
-                self._sync_stamp = self._buffer[0][0]
-                self._sync_id = -1
-                self._sync_offset = 0
-            else:
-                if isinstance(self._postinfo, bool):
-                    path_next = get_next_path(self._path)
-                    ned = ElData(path_next)
-                    if not self._skip:  # searching for synchronization
-                        self._sync_id = ned.defrag(self._sync_id,
-                                                   self._sync_count)
-                    else:
-                        (self._sync_stamp,
-                         self._sync_id,
-                         self._sync_offset), _ = ned.get_first_sync()
-                else:
-                    (self._sync_stamp,
-                     self._sync_id,
-                     self._sync_offset), _ = self._postinfo
-            self._sync_replace()
-
-            return self.__next__()
-
-        # Parse
-        stamp, data, d_type = parsebytes(tmpd)
-
-        # Buffering
-        if d_type == DataType.DATA:
-            self._buffer.append([stamp, data,
-                                 self._sync_info[-1][1],  # SYNC ID
-                                 self._sync_info[-1][2]])  # SYNC OFFSET
-            if not self._init:  # First data stamp
-                self.__sstamp = stamp
-                self._init = True
-        else:
-            self._sync_push((stamp, data, d_type))
-
-        # Output
-        if len(self._buffer) < BUFFER_LENGTH:
-            return self.__next__()
-
-        if self._use_deque:
-            return self._buffer.popleft()
-
-        return self._buffer.pop(0)
-
     def _uart_fragment(self):
         cur_pos = self._tell()
         uarts = []
@@ -378,10 +452,90 @@ class ElData:
         ret_list: np.array
             Array of [stamp, data, sync_id, offset]
         '''
-        ret_list = []
-        for stmp, data, sid, soff in self:
-            ret_list.append([stmp, data, sid, soff])
-        return np.array(ret_list)
+        return self._parse_packets(self._packets())
+
+    def _packets(self):
+        '''Packets in the file as a structured array'''
+        if self._isxz:
+            # Decompress once instead of seeking to the end for the length
+            self._seek(0)
+            body = memoryview(self._fd.read())
+            body = body[:len(body) - len(body) % PACKET_LENGTH]
+            self._length = len(body)//PACKET_LENGTH
+            return np.frombuffer(body, dtype=PKT_DTYPE)
+
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self._mm.madvise(mmap.MADV_SEQUENTIAL)
+        return np.frombuffer(self._read_block(0, self.length),
+                             dtype=PKT_DTYPE)
+
+    def _parse_packets(self, arr):
+        '''Parse the packets in `arr`.
+        A DATA packet gets the last synchronization completed before it.
+        A synchronization also applies to the preceding DATA packets in the
+        window of BUFFER_LENGTH - 1 packets whose timestamps are later than
+        its SYNC. DATA packets are handled with NumPy. Only SYNC and UART
+        packets, which are rare, go through the synchronization state machine.
+        '''
+        is_data, is_sync = classify(arr)
+        # Columns are filled in place: [stamp, data, sync_id, offset]
+        ret = np.empty((np.count_nonzero(is_data), 4), dtype=np.int64)
+        stamp, data, sid, soff = ret.T
+        stamp[:] = arr['stamp'][is_data]
+        data[:] = arr['data'][is_data]
+        self._fin = True
+        if len(stamp) == 0:
+            return ret
+        if not self._init:  # First data stamp
+            self.__sstamp = int(stamp[0])
+            self._init = True
+
+        # Number of DATA packets read when each synchronization flushes
+        n_data = np.cumsum(is_data)
+        ctl = np.flatnonzero(~is_data)
+        n_info = len(self._sync_info)
+        flush_at = []
+        for _i, c_stamp, c_data, c_sync in zip(ctl.tolist(),
+                                               arr['stamp'][ctl].tolist(),
+                                               arr['data'][ctl].tolist(),
+                                               is_sync[ctl].tolist()):
+            _n = len(self._sync_info)
+            d_type = DataType.SYNC if c_sync else DataType.UART
+            self._sync_push((c_stamp, c_data, d_type))
+            if len(self._sync_info) != _n:
+                flush_at.append(int(n_data[_i]))
+
+        # Synchronization at the time each DATA packet is read
+        info = np.array(self._sync_info[n_info - 1:], dtype=np.int64)
+        counts = np.diff(np.asarray(flush_at, dtype=np.int64),
+                         prepend=0, append=len(stamp))
+        sid[:] = np.repeat(info[:, 1], counts)
+        soff[:] = np.repeat(info[:, 2], counts)
+
+        # Replacement in the window preceding each flush
+        for end, (sync_stamp, sync_id, sync_offset) in zip(
+                flush_at, self._sync_info[n_info:]):
+            self._replace_window(stamp, sid, soff, end,
+                                 sync_stamp, sync_id, sync_offset)
+
+        self._eof_sync(int(stamp[max(len(stamp) - BUFFER_LENGTH + 1, 0)]))
+        self._replace_window(stamp, sid, soff, len(stamp), self._sync_stamp,
+                             self._sync_id, self._sync_offset)
+
+        return ret
+
+    def _replace_window(self, stamp, sid, soff, end,
+                        sync_stamp, sync_id, sync_offset):
+        '''Give a synchronization to the packets in the window of
+        BUFFER_LENGTH - 1 DATA packets before `end`'''
+        start = max(end - BUFFER_LENGTH + 1, 0)
+        if start == end:
+            return
+
+        start += self._sync_index(int(stamp[start]), sync_stamp)
+        mask = stamp[start:end] > sync_stamp
+        sid[start:end][mask] = sync_id
+        soff[start:end][mask] = sync_offset
 
     def get_data(self, cur):
         '''Get data at the given position
@@ -399,20 +553,58 @@ class ElData:
         self._seek(cur)
         return parsebytes(self._read())
 
+    def get_tail_data(self, nbytes=TAIL_LENGTH):
+        '''Get the last DATA packet in the file with a single read
+        Parameter
+        ---------
+        nbytes: int
+            Number of bytes to read from the end of the file
+
+        Returns
+        -------
+        stamp: int
+        data: int
+            None if no DATA packet is found in the last `nbytes` bytes
+        '''
+        cur = max(self.length - nbytes//PACKET_LENGTH, 0)
+        blob = self._read_block(cur, self.length - cur)
+        for _i in range(len(blob) - PACKET_LENGTH, -1, -PACKET_LENGTH):
+            if blob[_i+10:_i+12] == b'z\xda' and blob[_i:_i+2] == b'\x07\x12':
+                return struct.unpack_from('<Ii', blob, _i + 2)
+
+        return None
+
     def _read(self):
-        buf = self._fd.read(PACKET_LENGTH)
+        if self._isxz:
+            buf = self._fd.read(PACKET_LENGTH)
+        else:
+            buf = self._mv[self._pos:self._pos + PACKET_LENGTH]
+            self._pos += len(buf)
         if len(buf) != PACKET_LENGTH:
             raise ElEOF
         return buf
 
+    def _read_block(self, cur, num):
+        '''Read `num` packets from the position `cur` at once'''
+        if self._isxz:
+            self._seek(cur)
+            return self._fd.read(PACKET_LENGTH*num)
+        pos = self._hlen + PACKET_LENGTH*cur
+        return self._mv[pos:pos + PACKET_LENGTH*num]
+
     def _seek(self, cur):
-        self._fd.seek(self._hlen + PACKET_LENGTH*cur)
+        if self._isxz:
+            self._fd.seek(self._hlen + PACKET_LENGTH*cur)
+        else:
+            self._pos = self._hlen + PACKET_LENGTH*cur
 
     def _tell(self):
-        return int((self._fd.tell() - self._hlen)/PACKET_LENGTH)
+        if self._isxz:
+            return int((self._fd.tell() - self._hlen)/PACKET_LENGTH)
+        return int((self._pos - self._hlen)/PACKET_LENGTH)
 
     def _find_sync(self, cur_st, cur_en):
-        cur_pos = self._fd.tell()
+        cur_pos = self._tell()
 
         sync_info = []
         uart_count = 0
@@ -421,41 +613,44 @@ class ElData:
         sync_stamp = 0
         sync_offset = 0
 
-        try:
-            self.get_data(cur_st)
-        except ElEOF:
+        blob = self._read_block(cur_st, max(cur_en - cur_st, 1))
+        if len(blob) < PACKET_LENGTH:
             raise ElEOF
-
-        for _i in range(cur_st, cur_en):
-            try:
-                stamp, data, d_type = self.get_data(_i)
-            except ElEOF:
-                break
-
-            if d_type == DataType.SYNC:
+        num = min(len(blob)//PACKET_LENGTH, max(cur_en - cur_st, 0))
+        arr = np.frombuffer(blob, dtype=PKT_DTYPE, count=num)
+        is_data, is_sync = classify(arr)
+
+        # Only SYNC/UART packets are visited. DATA packets matter only
+        # right after a complete sequence, which they close.
+        ctl = np.flatnonzero(~is_data)
+        data_after = np.diff(ctl, append=num) > 1
+        for stamp, data, c_sync, c_data_after in zip(
+                arr['stamp'][ctl].tolist(), arr['data'][ctl].tolist(),
+                is_sync[ctl].tolist(), data_after.tolist()):
+            if c_sync:
                 sync_in = True
                 sync_stamp = stamp
                 sync_offset = data
                 sync_id = 0
                 uart_count = 0
-            elif d_type == DataType.UART:
+            else:
                 if uart_count == 6:
                     raise Exception('UART too long')
                 if uart_count != 0:
                     sync_id += data << 8*(uart_count - 1)
                 uart_count += 1
-            else:  # d_type = DataType.DATA
-                if uart_count == 6:
-                    if sync_in:
-                        sync_info.append([sync_stamp, sync_id, sync_offset])
-                    sync_id = 0
-                    sync_in = False
+
+            if c_data_after and uart_count == 6:
+                if sync_in:
+                    sync_info.append([sync_stamp, sync_id, sync_offset])
+                sync_id = 0
+                sync_in = False
 
         # Back
         if sync_in:
             sync_info.append([sync_stamp, sync_id, sync_offset])
 
-        self._fd.seek(cur_pos)
+        self._seek(cur_pos)
         return sync_info, uart_count
 
     def get_last_sync(self, seek_from=0, seek_length=SEEK_LENGTH,
@@ -1,20 +1,33 @@
 #!/usr/bin/env python3
 '''Module to run elevation encoder reader
 '''
+import asyncio
+import ctypes
+import errno
+import fcntl
+import lzma
+import mmap
+import os
 import socket
+import struct
 import sys
 import datetime
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timezone
 from pathlib import Path
 from os import getpid
 from common import is_writable
-from time import sleep
+from time import sleep, time
 
 
 SERVER_IP = '192.168.10.13'
 SERVER_PORT = 7
-RECV_BUFLEN = 128*12
+WRITE_LEN = 64*1024 # bytes received before each write to the file, multiple of DIRECT_ALIGN
+DIRECT_ALIGN = 4096 # alignment of offsets and lengths of O_DIRECT writes
+XZ_PRESET = 1 # preset of the compressor for the compressed output
+RCVBUF_SIZE = 4*1024*1024 # kernel receive buffer size in bytes
+WRITEBACK_LEN = 4*1024*1024 # bytes written before the pages are flushed and dropped
 FILE_LEN = 1000000 # numbrer of packets per file
 DIR_BASE = Path('/home/gb/logger/bdata/el_enc')
 LOCK_PATH = Path('/tmp/el_enc.lock')
@@ -29,6 +42,106 @@ BODY + FOOTER:
 \tSYNC: [timestamp] [offset] 0x0C 0x57
 \tUART: [timestamp] [UART data] 0x48 0x20
 '''
+# Header length, version, unix time (integer part) and microseconds
+_HDR = struct.Struct('<4sIII')
+
+# sync_file_range(2) is not exposed by the os module
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+try:
+    _sync_file_range = ctypes.CDLL(None, use_errno=True).sync_file_range
+    _sync_file_range.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint)
+except (OSError, AttributeError):
+    _sync_file_range = None
+
+
+def sync_range(fd, offset, nbytes, flags):
+    '''sync_file_range(2), raising OSError on failure'''
+    if _sync_file_range(fd, offset, nbytes, flags) == -1:
+        err = ctypes.get_errno()
+        raise OSError(err, f'sync_file_range: {os.strerror(err)}')
+
+
+def writeback(fd, prev_start, start, end):
+    '''Bounded writeback of a file being written sequentially.
+    Start writing [start, end) to the disk, then wait for [prev_start, start),
+    whose writeback was started by the previous call, and drop it from the
+    page cache. Keeps the amount of dirty and cached pages of the file bounded.
+    Parameters
+    ----------
+    fd: int
+        File descriptor
+    prev_start: int
+        Start of the range given at the previous call
+    start: int
+        Start of the range to write back
+    end: int
+        End of the range to write back
+    '''
+    if _sync_file_range is None:
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, prev_start, end - prev_start, os.POSIX_FADV_DONTNEED)
+        return
+
+    sync_range(fd, start, end - start, SYNC_FILE_RANGE_WRITE)
+    if start > prev_start:
+        sync_range(fd, prev_start, start - prev_start,
+                   SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE |
+                   SYNC_FILE_RANGE_WAIT_AFTER)
+        os.posix_fadvise(fd, prev_start, start - prev_start, os.POSIX_FADV_DONTNEED)
+
+
+def open_direct(path, direct=True):
+    '''Create a new file for writing, bypassing the page cache if possible
+    Parameters
+    ----------
+    path: pathlib.Path
+        Path to the file
+    direct: bool, default True
+        Try O_DIRECT
+
+    Returns
+    -------
+    fd: int
+        File descriptor
+    direct: bool
+        True if the file is opened with O_DIRECT
+    '''
+    # Exclusive creation fails atomically on a filename collision
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    try:
+        if direct:
+            try:
+                return os.open(path, flags | os.O_DIRECT, 0o666), True
+            except OSError as err:
+                # e.g. tmpfs does not support O_DIRECT
+                if err.errno != errno.EINVAL:
+                    raise
+
+        return os.open(path, flags, 0o666), False
+    except FileExistsError:
+        raise RuntimeError(f'Filename collision: {path}.') from None
+
+
+def set_direct(fd, direct):
+    '''Set or clear O_DIRECT of a file descriptor'''
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    if direct:
+        flags |= os.O_DIRECT
+    else:
+        flags &= ~os.O_DIRECT
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+
+def write_all(fd, data):
+    '''Write whole data to a file descriptor'''
+    while len(data) > 0:
+        data = data[os.write(fd, data):]
+
+
+# Directory of the day last created by path_creator, per base directory
+_DAY_DIRS = {}
 
 
 def path_checker(path):
@@ -58,34 +171,41 @@ def path_creator(dirpath, fmt=FNAME_FORMAT):
         Path to a new file
     '''
     utcnow = datetime.datetime.now(tz=timezone.utc)
-    _d = dirpath.joinpath(f'{utcnow.year:04d}')
-    _d = _d.joinpath(f'{utcnow.month:02d}')
-    _d = _d.joinpath(f'{utcnow.day:02d}')
-    _d.mkdir(exist_ok=True, parents=True)
-    path = _d.joinpath(utcnow.strftime(fmt))
-    if path.exists():
-        raise RuntimeError(f'Filename collision: {path}.')
-    return path
+    day = utcnow.toordinal()
+    cached = _DAY_DIRS.get(dirpath)
+    if (cached is None) or (cached[0] != day):
+        _d = dirpath / f'{utcnow.year:04d}/{utcnow.month:02d}/{utcnow.day:02d}'
+        _d.mkdir(exist_ok=True, parents=True)
+        cached = _DAY_DIRS[dirpath] = (day, _d)
+    return cached[1] / utcnow.strftime(fmt)
 
 
 class ElRead:
     '''Class to read elevation data'''
-    def __init__(self, ip_addr=SERVER_IP, port=SERVER_PORT, verbose=False, lockpath=LOCK_PATH):
+    def __init__(self, ip_addr=SERVER_IP, port=SERVER_PORT, verbose=False, lockpath=LOCK_PATH,
+                 compress=False):
         self._verbose = verbose
+        # Write files compressed in the xz format, with '.xz' appended to the name.
+        # They can be read only once complete, so cur_tail cannot follow them.
+        self._compress = compress
         self._connected = False
 
         # Avoiding multiple launch
         self._lockpath = lockpath
         self._locked = False
 
-        if lockpath.exists():
-            raise RuntimeError(f'Locked: {lockpath}')
-
         if not is_writable(lockpath.parent):
             raise RuntimeError(f'No write access to {lockpath.parent}')
 
-        with open(lockpath, 'w') as _f:
-            _f.write(f'{getpid()}\n')
+        # Exclusive creation: of two concurrent launches only one succeeds
+        try:
+            lock_fd = os.open(lockpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            raise RuntimeError(f'Locked: {lockpath}') from None
+        try:
+            os.write(lock_fd, f'{getpid()}\n'.encode())
+        finally:
+            os.close(lock_fd)
 
         self._locked = True
 
@@ -93,7 +213,18 @@ class ElRead:
         self._ip_addr = ip_addr
         self._port = port
         self._client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
+        self._client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+        # The kernel may clip (and on Linux doubles) the requested size
+        rcvbuf = self._client.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self._eprint(f'SO_RCVBUF: {rcvbuf} bytes')
+
+        # Receive buffer, written to the file when full.
+        # Anonymous mmap is page-aligned as required by O_DIRECT.
+        self._buf = mmap.mmap(-1, WRITE_LEN)
+        self._filled = None # bytes received into the current chunk
+        # File I/O of aget_write, kept off the event loop and in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
 
     def __del__(self):
         self._eprint('Deleted.')
@@ -114,6 +245,17 @@ class ElRead:
             sleep(1)
             self._connected = True
 
+    async def _aconnect(self):
+        '''Coroutine version of `_connect`. Makes the socket non-blocking.'''
+        self._client.setblocking(False)
+        if self._connected:
+            self._eprint('Already connected.')
+        else:
+            loop = asyncio.get_running_loop()
+            await loop.sock_connect(self._client, (self._ip_addr, self._port))
+            await asyncio.sleep(1)
+            self._connected = True
+
     def _close(self):
         if self._connected:
             self._client.close()
@@ -174,6 +316,37 @@ class ElRead:
             self._close()
             self._eprint('Fin.')
 
+    async def aloop(self, length=FILE_LEN, path=None):
+        '''Coroutine version of `loop`.
+        Several readers, each with its own lock path and directory,
+        can be run in one process with `asyncio.gather`.
+        The socket is made non-blocking: use `aget_write` afterwards.
+        Parameters
+        ----------
+        length: int
+            Number of packets to read
+        path: pathlib.Path or None, default None
+            Path to the parent directory.
+        '''
+        if path is not None:
+            path = Path(path)
+            path_checker(path)
+
+        self._eprint('Lets start')
+        await self._aconnect()
+        try:
+            while True:
+                if path is None:
+                    await self.aget_write(length)
+                else:
+                    await self.aget_write(length, path_creator(path))
+
+        except asyncio.CancelledError:
+            self._eprint('Cancelled.')
+            self._eprint('TCP connection aborted.')
+            self._close()
+            raise
+
     def get_write(self, data_num, path=None):
         '''Get data and write it to a file
         Parameters
@@ -183,42 +356,140 @@ class ElRead:
         path: pathlib.Path or None, default None
             Path to the file
         '''
+        chunks = self._write_chunks(data_num, path)
+        try:
+            for chunk in chunks:
+                # MSG_WAITALL fills the chunk in one call unless interrupted
+                rest = len(chunk)
+                while rest:
+                    num = self._client.recv_into(chunk[self._filled:], rest, socket.MSG_WAITALL)
+                    if not num:
+                        raise ConnectionError('Connection closed.')
+                    self._filled += num
+                    rest -= num
+        finally:
+            chunks.close() # writes a partially filled chunk
+
+    async def aget_write(self, data_num, path=None):
+        '''Coroutine version of `get_write` for a non-blocking socket
+        Parameters
+        ----------
+        data_num: int
+            Number of packets to read
+        path: pathlib.Path or None, default None
+            Path to the file
+        '''
+        loop = asyncio.get_running_loop()
+        chunks = self._write_chunks(data_num, path)
+        try:
+            # The generator writes the file when resumed: it runs in the
+            # executor so that other readers on the loop are not stalled.
+            chunk = await loop.run_in_executor(self._executor, next, chunks, None)
+            while chunk is not None:
+                rest = len(chunk)
+                while rest:
+                    num = await loop.sock_recv_into(self._client, chunk[self._filled:])
+                    if not num:
+                        raise ConnectionError('Connection closed.')
+                    self._filled += num
+                    rest -= num
+                chunk = await loop.run_in_executor(self._executor, next, chunks, None)
+        finally:
+            # Queued after a step still running if cancelled meanwhile
+            await loop.run_in_executor(self._executor, chunks.close)
+
+    def _write_chunks(self, data_num, path):
+        '''Write a file from the receive buffer.
+        Yields parts of the buffer that the caller must fill
+        before resuming, each is written to the file afterwards.
+        The caller counts the bytes it has received into the part in
+        `self._filled`: if the generator is closed before the part is
+        full, they are written to the file.
+        '''
         if not self._connected:
             raise RuntimeError('Not connected.')
 
         rest = 12*data_num
-        current_time = datetime.datetime.now()
+        utime = time()
         if path is None:
+            current_time = datetime.datetime.fromtimestamp(utime, tz=timezone.utc)
             path = Path('.').joinpath(current_time.strftime(FNAME_FORMAT))
-
-        with open(path, 'wb') as file_desc:
-            # HEADER
-            header = b''
-            header += b'256\n' # 4 bytes, 256 is the length of the header
-
-            # 4 bytes, version number of the logger software
-            header += VERSION.to_bytes(4, 'little', signed=False)
-            utime = current_time.timestamp()
-            utime_int = int(utime)
-
-            # 4 bytes, integer part of the current time in unix time
-            header += utime_int.to_bytes(4, 'little', signed=False)
-            # microseconds
-            header += int((utime - utime_int)*1e6).to_bytes(4, 'little', signed=False)
-            header += HEADER_TXT
-            res = 256 - len(header)
-            if res < 0:
-                raise Exception('HEADER TOO LONG')
-            header += b' '*res # adjust header size with white spaces
-
-            file_desc.write(header)
+        if self._compress:
+            path = Path(path)
+            path = path.with_name(path.name + '.xz')
+
+        # HEADER
+        utime_int = int(utime)
+        head = _HDR.pack(b'256\n', # 256 is the length of the header
+                         VERSION, # version number of the logger software
+                         utime_int, # integer part of the current time in unix time
+                         int((utime - utime_int)*1e6)) # microseconds
+        header = head + HEADER_TXT
+        res = 256 - len(header)
+        if res < 0:
+            raise Exception('HEADER TOO LONG')
+        header += b' '*res # adjust header size with white spaces
+
+        view = memoryview(self._buf)
+        size = len(header) + rest
+
+        comp = lzma.LZMACompressor(preset=XZ_PRESET) if self._compress else None
+        fd, direct_ok = open_direct(path, direct=comp is None)
+        try:
+            # The header is written at once so that readers of the latest
+            # file (cur_tail) never see it empty. Body chunks end on
+            # multiples of WRITE_LEN: O_DIRECT is used from the first
+            # aligned chunk on, unaligned ones go through the page cache.
+            direct = False
+            if direct_ok:
+                set_direct(fd, False)
+            out = header if comp is None else comp.compress(header)
+            write_all(fd, out)
 
             # BODY
-            while rest > 0:
-                recv_num = RECV_BUFLEN if (rest > RECV_BUFLEN) else rest
-                data = self._client.recv(recv_num)
-                file_desc.write(data)
-                rest = rest - len(data)
+            pos = len(header) # offset of the head of the buffer in the data
+            written = len(out) # bytes written to the file
+            wb_prev = wb_start = 0
+            while pos < size:
+                fill = min(WRITE_LEN - pos % WRITE_LEN, size - pos)
+                self._filled = 0
+                yield view[:fill]
+                self._filled = None
+
+                if comp is not None:
+                    out = comp.compress(view[:fill])
+                    if pos + fill >= size:
+                        out += comp.flush()
+                        comp = None # the stream is complete
+                    write_all(fd, out)
+                    written += len(out)
+                else:
+                    aligned = direct_ok and (pos % DIRECT_ALIGN == 0) and (fill % DIRECT_ALIGN == 0)
+                    if aligned != direct:
+                        set_direct(fd, aligned)
+                        direct = aligned
+                    write_all(fd, view[:fill])
+                    written += fill
+                pos += fill
+
+                if (not direct) and (written - wb_start >= WRITEBACK_LEN):
+                    writeback(fd, wb_prev, wb_start, written)
+                    wb_prev, wb_start = wb_start, written
+        finally:
+            try:
+                # Data of an interrupted chunk
+                filled = self._filled
+                self._filled = None
+                if comp is not None:
+                    # Complete the stream to keep the file readable
+                    out = comp.compress(view[:filled]) if filled else b''
+                    write_all(fd, out + comp.flush())
+                elif filled:
+                    if direct:
+                        set_direct(fd, False)
+                    write_all(fd, view[:filled])
+            finally:
+                os.close(fd)
 
 
 def main():
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 '''Provides utility for elevation data analysis
 '''
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+import os
 import numpy as np
 
 import sys
@@ -14,6 +18,20 @@ from eldata import ElData
 
 EL_FMT = '{:/data/gb/logbdata/el_enc/%Y/%m/%d/el_%Y-%m%d-%H%M%S+0000.dat.xz}'
 
+def _list_dir(pdir, suffix):
+    '''Sorted paths in `pdir` with the extension `suffix`.
+    Listings are cached as long as the directory is not modified.
+    '''
+    return _list_dir_cached(pdir, suffix, pdir.stat().st_mtime_ns)
+
+@lru_cache(maxsize=256)
+def _list_dir_cached(pdir, suffix, mtime_ns):
+    with os.scandir(pdir) as entries:
+        # '*' of glob does not match hidden files
+        names = sorted(_e.name for _e in entries
+                       if _e.name.endswith(suffix) and not _e.name.startswith('.'))
+    return tuple(pdir / name for name in names)
+
 def dt2elpath(dt_tgt):
     '''Find a path to elevation data that covers the given `dt_tgt`
     Parameter
@@ -28,8 +46,8 @@ def dt2elpath(dt_tgt):
     '''
     path_fake = Path(EL_FMT.format(dt_tgt))
     pdir = path_fake.parent
-    ppaths = sorted(pdir.glob('*' + path_fake.suffix))
-    ind = np.searchsorted(ppaths, path_fake)
+    ppaths = _list_dir(pdir, path_fake.suffix)
+    ind = bisect_left(ppaths, path_fake)
 
     return get_previous_path(ppaths[ind])
 
@@ -56,7 +74,7 @@ def span2elpaths(dt_start, dt_end):
     _pdir = path_st.parent
 
     while True:
-        p_gl = sorted(_pdir.glob('*' + path_st.suffix))
+        p_gl = _list_dir(_pdir, path_st.suffix)
 
         if path_en in p_gl:
             paths += p_gl[:p_gl.index(path_en)+1]
@@ -77,21 +95,42 @@ def elpaths2el(elpaths):
     el_data: array-like
         Length x 5 array (stamp, unixtime, data, sync_no, sync_offset)
     '''
-    eld_list = [ElData(path, preinfo=True, postinfo=True) for path in elpaths]
-    print(eld_list)
-    length = sum([eld.length for eld in eld_list])
-    el_data = np.zeros((length, 5)) # stamp, unixtime, data, syn_no, offset
+    # Files are decompressed and parsed in parallel: lzma releases the GIL
+    with ThreadPoolExecutor() as executor:
+        parsed = list(executor.map(_parse_elpath, elpaths))
+
+    length = sum([len(tmpd) for _, tmpd in parsed])
+    el_data = np.empty((length, 5)) # stamp, unixtime, data, syn_no, offset
     cur = 0
-    dt_st = eld_list[0].c_utime
+    dt_st = parsed[0][0]
     st_st = None
-    for eld in eld_list:
-        tmpd = eld.parse_all()
+    for _, tmpd in parsed:
         if st_st is None:
             st_st = tmpd[0][0]
 
         tmplen = len(tmpd)
-        el_data[cur:cur+tmplen, 0] = tmpd[:, 0] # stamp
-        el_data[cur:cur+tmplen, 2:] = tmpd[:, 1:] # data, syn_no, offset
-        el_data[cur:cur+tmplen, 1] = dt_st + (tmpd[:, 0] - st_st)/1e3
+        dst = el_data[cur:cur+tmplen]
+        dst[:, 0] = tmpd[:, 0] # stamp
+        dst[:, 2:] = tmpd[:, 1:] # data, syn_no, offset
+        # unixtime: dt_st + (stamp - st_st)/1e3
+        np.subtract(tmpd[:, 0], st_st, out=dst[:, 1])
+        np.divide(dst[:, 1], 1e3, out=dst[:, 1])
+        np.add(dst[:, 1], dt_st, out=dst[:, 1])
         cur = cur + tmplen
-    return el_data[:cur]
+    return el_data
+
+
+def _parse_elpath(path):
+    '''Parse a file with the synchronization of its neighbors
+    Returns
+    -------
+    c_utime: float
+        Creation unix time of the file
+    data: np.array
+        Array of [stamp, data, sync_id, offset]
+    '''
+    eld = ElData(path, preinfo=True, postinfo=True)
+    try:
+        return eld.c_utime, eld.parse_all()
+    finally:
+        eld.close()